@@ -1,12 +1,23 @@
 import os
+from datetime import datetime
 from http import HTTPStatus
 
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request, abort
+from flask import Flask, Response, jsonify, request, abort
 from flask_cors import CORS
+from sqlalchemy.orm.exc import StaleDataError
 
+import auth
+import runtime
 from auth import requires_auth, AuthError
-from models import setup_db, Actor, GenderEnum, Movie
+from cache import caches, configure_caches
+from encoding import msgpack_response, pack_models, pack_rows, wants_msgpack
+from idempotency import idempotent
+from profiler import profiler, setup_profiler
+from querybudget import extend_query_budget, query_budget, setup_query_budget
+from models import (
+    setup_db, db, delete_versioned, fits_integer, get_many, row_exists, update_versioned, Actor, GenderEnum, Movie
+)
 
 load_dotenv()
 
@@ -22,20 +33,33 @@ def create_app(config=os.environ['APP_SETTINGS']):
     app.config.from_object(config)
 
     setup_db(app)
+    setup_query_budget(app, db.get_engine(app))
+    setup_profiler(app)
+    configure_caches(app)
 
     # Set up CORS. Allow '*' for origins.
-    CORS(app, resources={r"*": {"origins": "*"}})
+    CORS(app, resources={r"*": {"origins": "*"}}, expose_headers=["ETag"])
 
     # Use the after_request decorator to set Access-Control-Allow
 
     @app.after_request
     def after_request(response):
         response.headers.add("Access-Control-Allow-Headers",
-                             "Content-Type,Authorization,true")
+                             "Content-Type,Authorization,If-Match,Idempotency-Key,X-Profile,true")
         response.headers.add("Access-Control-Allow-Methods",
                              "GET,PATCH,POST,DELETE,OPTIONS")
         return response
 
+    # count the requests in flight for /debug/runtime
+
+    @app.before_request
+    def count_request():
+        runtime.in_flight.increment()
+
+    @app.teardown_request
+    def uncount_request(error):
+        runtime.in_flight.decrement()
+
     @app.route('/')
     def default_route():
         """
@@ -43,6 +67,78 @@ def create_app(config=os.environ['APP_SETTINGS']):
         """
         return 'Welcome to Agency'
 
+    # Health routes
+
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        """
+        Liveness, the process is up and serving requests
+        Touches nothing else so it stays cheap
+        """
+        return jsonify(status='ok'), HTTPStatus.OK
+
+    @app.route('/readyz', methods=['GET'])
+    def readyz():
+        """
+        Readiness, the database answers within READINESS_TIMEOUT_MS
+        and the keys used to verify tokens are loaded
+        -> 503 error response if either isn't the case
+        """
+        checks = {}
+
+        # the errors go to the log only, they can name hosts and users
+        try:
+            runtime.ping_database(db.engine, app.config['READINESS_TIMEOUT_MS'])
+            checks['database'] = 'ok'
+        except Exception:
+            app.logger.exception('readiness check of the database failed')
+            checks['database'] = 'unavailable'
+
+        try:
+            keys = auth.get_jwks().get('keys')
+            checks['keys'] = 'ok' if keys else 'no keys'
+        except Exception:
+            app.logger.exception('readiness check of the token keys failed')
+            checks['keys'] = 'unavailable'
+
+        ready = all(check == 'ok' for check in checks.values())
+        status = HTTPStatus.OK if ready else HTTPStatus.SERVICE_UNAVAILABLE
+        return jsonify(ready=ready, checks=checks), status
+
+    @app.route('/debug/runtime', methods=['GET'])
+    @requires_auth(permission='get:runtime')
+    def debug_runtime():
+        """
+        Statistics of the worker that serves the request
+        """
+        return jsonify(dict(runtime.snapshot(db.engine, caches), profiler=profiler.stats())), HTTPStatus.OK
+
+    @app.route('/debug/profile', methods=['GET'])
+    @requires_auth(permission='get:runtime')
+    def debug_profile():
+        """
+        The stacks sampled in this worker as collapsed stacks, for flamegraph.pl
+        or speedscope, optionally only those of ?route=GET /actors
+        """
+        return Response(profiler.collapsed(request.args.get('route')), mimetype='text/plain')
+
+    @app.route('/debug/profile', methods=['DELETE'])
+    @requires_auth(permission='get:runtime')
+    def reset_profile():
+        profiler.reset()
+        return jsonify(success=True), HTTPStatus.OK
+
+    @app.route('/debug/permissions', methods=['GET'])
+    @requires_auth(permission='get:runtime')
+    def debug_permissions():
+        """
+        Which permission every route requires and which roles have it
+        """
+        return jsonify(
+            routes=app.extensions['permissions'],
+            roles=auth.ROLE_PERMISSIONS
+        ), HTTPStatus.OK
+
     # Helper functions
 
     def serialize_list(model_list: list):
@@ -53,17 +149,171 @@ def create_app(config=os.environ['APP_SETTINGS']):
         """
         return [i.serialize for i in model_list]
 
+    def list_response(name: str, model, query, **extra):
+        """
+        The rows of query under name, as JSON or as MessagePack if the client
+        prefers it (see encoding.py), extra goes into the body as is
+        MessagePack is packed straight from the row tuples, no model is loaded
+        """
+        if wants_msgpack():
+            rows = query.with_entities(*(getattr(model, field) for field in model.fields))
+            return msgpack_response(pack_rows(name, model.fields, rows, **extra)), HTTPStatus.OK
+        response = jsonify({name: serialize_list(query.all()), **extra})
+        response.vary.add('Accept')
+        return response, HTTPStatus.OK
+
+    def batch_response(name: str, model, models: list, missing: list):
+        """list_response for the models get_batch loaded"""
+        if wants_msgpack():
+            return msgpack_response(pack_models(name, model.fields, models, missing=missing)), HTTPStatus.OK
+        response = jsonify({name: serialize_list(models), "missing": missing})
+        response.vary.add('Accept')
+        return response, HTTPStatus.OK
+
+    def apply_list_params(query, model, sortable: tuple, filterable: tuple):
+        """
+        Applies the optional query string parameters of the list routes
+            ?sort=<column>&order=asc|desc
+            ?min_<column>=<int>&max_<column>=<int>
+        Only whitelisted columns are accepted, anything else -> 400 error response
+        The counter columns live on the row itself so none of this needs a join
+        """
+        for name in filterable:
+            column = getattr(model, name)
+            for prefix, compare in (('min_', column.__ge__), ('max_', column.__le__)):
+                value = request.args.get(prefix + name)
+                if value is None:
+                    continue
+                try:
+                    value = int(value)
+                except ValueError:
+                    abort(HTTPStatus.BAD_REQUEST)
+                if not fits_integer(value):
+                    abort(HTTPStatus.BAD_REQUEST)
+                query = query.filter(compare(value))
+
+        sort = request.args.get('sort', 'id')
+        order = request.args.get('order', 'asc')
+        if sort not in sortable or order not in ('asc', 'desc'):
+            abort(HTTPStatus.BAD_REQUEST)
+
+        column = getattr(model, sort)
+        ordering = column.desc() if order == 'desc' else column.asc()
+        # tie-break on the primary key so pages are stable
+        return query.order_by(ordering, model.id.asc())
+
+    def get_batch(model, ids):
+        """
+        Rows for a list of ids, in the order asked for (duplicates dropped)
+        and the ids no row was found for
+        Too many ids or anything but integers within the INTEGER range of the
+        primary key -> 400 error response
+        """
+        if not isinstance(ids, list) or len(ids) > app.config['BATCH_MAX_IDS']:
+            abort(HTTPStatus.BAD_REQUEST)
+        if not all(isinstance(key, int) and not isinstance(key, bool) and fits_integer(key) for key in ids):
+            abort(HTTPStatus.BAD_REQUEST)
+
+        ids = list(dict.fromkeys(ids))
+        # one query per chunk, the routes' budget covers the first
+        chunks = -(-len(ids) // app.config['BATCH_CHUNK_SIZE'])
+        extend_query_budget(max(chunks - 1, 0), repeats=max(chunks - 1, 0))
+        rows = get_many(model, ids, app.config['BATCH_CHUNK_SIZE'])
+        found = [rows[key] for key in ids if key in rows]
+        missing = [key for key in ids if key not in rows]
+        return found, missing
+
+    def date_arg(name: str):
+        """
+        An optional ISO 8601 date query string parameter
+        Anything else -> 400 error response
+        """
+        value = request.args.get(name)
+        if value is None:
+            return None
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            abort(HTTPStatus.BAD_REQUEST)
+
+    def if_match_versions():
+        """
+        The versions named by the If-Match request header
+        None without the header or for If-Match: *, which match any version
+        If-Match compares strongly, weak ETags and ETags that aren't versions
+        can't match anything, neither can ETags beyond the INTEGER range of the
+        version column. Nothing left -> 412 error response
+        """
+        if_match = request.if_match
+        if not if_match or if_match.star_tag:
+            return None
+        # isdigit alone takes digits such as ² that int() refuses
+        versions = [
+            int(etag) for etag in if_match.as_set()
+            if etag.isascii() and etag.isdigit() and fits_integer(int(etag))
+        ]
+        if not versions:
+            abort(HTTPStatus.PRECONDITION_FAILED)
+        return versions
+
+    def patch_versioned(model, key: int, values: dict):
+        """
+        Applies a PATCH with one conditional UPDATE, no row lock and no SELECT first
+        The response carries the new version as its ETag
+        Only when nothing matched is the row looked up to tell a missing row
+        (404 error response) from a stale If-Match (412 error response)
+        """
+        versions = if_match_versions()
+        version = update_versioned(model, key, values, versions)
+        if version is None:
+            if versions and row_exists(model, key):
+                abort(HTTPStatus.PRECONDITION_FAILED)
+            abort(HTTPStatus.NOT_FOUND)
+        db.session.commit()
+
+        response = jsonify(success=True)
+        response.set_etag(str(version))
+        return response, HTTPStatus.OK
+
+    def delete_versioned_row(model, key: int):
+        """
+        Applies a DELETE with one conditional DELETE statement, the row isn't
+        loaded into the session and the database cascades to the jobs
+        404 and 412 error responses are told apart as in patch_versioned
+        """
+        versions = if_match_versions()
+        if not delete_versioned(model, key, versions):
+            if versions and row_exists(model, key):
+                abort(HTTPStatus.PRECONDITION_FAILED)
+            abort(HTTPStatus.NOT_FOUND)
+        db.session.commit()
+        return jsonify(success=True), HTTPStatus.OK
+
     # Actor Routes
 
     @app.route('/actors', methods=['GET'])
     @requires_auth(permission='get:actors')
+    @query_budget(1)
     def get_actors():
-        actors = Actor.query.all()
-        actors_serialized = serialize_list(actors)
-        return jsonify({"actors": actors_serialized}), HTTPStatus.OK
+        if 'ids' in request.args:
+            try:
+                ids = [int(key) for key in request.args['ids'].split(',')]
+            except ValueError:
+                abort(HTTPStatus.BAD_REQUEST)
+            actors, missing = get_batch(Actor, ids)
+            return batch_response("actors", Actor, actors, missing)
+
+        query = apply_list_params(
+            Actor.query, Actor,
+            sortable=('id', 'name', 'age', 'movie_count'),
+            filterable=('movie_count',)
+        )
+        return list_response("actors", Actor, query)
 
     @app.route('/actors', methods=['POST'])
     @requires_auth(permission='post:actors')
+    @query_budget(3)
+    @idempotent
     def post_actor():
         json = request.get_json()
 
@@ -83,44 +333,69 @@ def create_app(config=os.environ['APP_SETTINGS']):
 
     @app.route('/actors/<int:key>', methods=['DELETE'])
     @requires_auth(permission='delete:actors')
+    @query_budget(2)
     def delete_actor(key: int):
-        actor = Actor.query.get_or_404(key)
-        actor.delete()
-        return jsonify(success=True), HTTPStatus.OK
+        return delete_versioned_row(Actor, key)
 
     @app.route('/actors/<int:key>', methods=['PATCH'])
     @requires_auth(permission='patch:actors')
+    @query_budget(3)
     def patch_actor(key: int):
         json = request.get_json()
-        actor = Actor.query.get_or_404(key)
+        values = {}
 
         name = json.get("name")
         if name is not None:
-            actor.name = name
+            values["name"] = name
 
         age = json.get("age")
         if age is not None:
-            actor.age = age
+            values["age"] = age
 
         gender = json.get("gender")
         if gender is not None:
-            actor.gender = GenderEnum.transform(gender)
+            values["gender"] = GenderEnum.transform(gender)
 
-        actor.update()
-
-        return jsonify(success=True), HTTPStatus.OK
+        return patch_versioned(Actor, key, values)
 
     # Movie handlers
 
     @app.route('/movies', methods=['GET'])
     @requires_auth(permission='get:movies')
+    @query_budget(1)
     def get_movies():
-        movies = Movie.query.all()
-        movies_serialized = serialize_list(movies)
-        return jsonify({"movies": movies_serialized}), HTTPStatus.OK
+        query = Movie.query
+
+        # with partitioned storage these only read the matching years
+        released_after = date_arg('released_after')
+        if released_after is not None:
+            query = query.filter(Movie.release_date >= released_after)
+        released_before = date_arg('released_before')
+        if released_before is not None:
+            query = query.filter(Movie.release_date < released_before)
+
+        query = apply_list_params(
+            query, Movie,
+            sortable=('id', 'title', 'release_date', 'cast_count'),
+            filterable=('cast_count',)
+        )
+        return list_response("movies", Movie, query)
+
+    @app.route('/movies/batch-get', methods=['POST'])
+    @requires_auth(permission='get:movies')
+    @query_budget(1)
+    def batch_get_movies():
+        json = request.get_json()
+        if not isinstance(json, dict):
+            abort(HTTPStatus.BAD_REQUEST)
+
+        movies, missing = get_batch(Movie, json.get("ids"))
+        return batch_response("movies", Movie, movies, missing)
 
     @app.route('/movies', methods=['POST'])
     @requires_auth(permission='post:movies')
+    @query_budget(3)
+    @idempotent
     def post_movie():
         json = request.get_json()
 
@@ -138,24 +413,22 @@ def create_app(config=os.environ['APP_SETTINGS']):
 
     @app.route('/movies/<int:key>', methods=['DELETE'])
     @requires_auth(permission='delete:movies')
+    @query_budget(2)
     def delete_movie(key: int):
-        movie = Movie.query.get_or_404(key)
-        movie.delete()
-        return jsonify(success=True), HTTPStatus.OK
+        return delete_versioned_row(Movie, key)
 
     @app.route('/movies/<int:key>', methods=['PATCH'])
     @requires_auth(permission='patch:movies')
+    @query_budget(3)
     def patch_movie(key: int):
         json = request.get_json()
-        movie = Movie.query.get_or_404(key)
+        values = {}
 
         title = json.get("title")
         if title is not None:
-            movie.title = title
-
-        movie.update()
+            values["title"] = title
 
-        return jsonify(success=True), HTTPStatus.OK
+        return patch_versioned(Movie, key, values)
 
     # Error handlers
 
@@ -211,6 +484,38 @@ def create_app(config=os.environ['APP_SETTINGS']):
             HTTPStatus.NOT_FOUND,
         )
 
+    @app.errorhandler(HTTPStatus.CONFLICT)
+    def conflict_409(error):
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": HTTPStatus.CONFLICT,
+                    "message": HTTPStatus.CONFLICT.phrase,
+                }
+            ),
+            HTTPStatus.CONFLICT,
+        )
+
+    @app.errorhandler(HTTPStatus.PRECONDITION_FAILED)
+    def precondition_failed_412(error):
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": HTTPStatus.PRECONDITION_FAILED,
+                    "message": HTTPStatus.PRECONDITION_FAILED.phrase,
+                }
+            ),
+            HTTPStatus.PRECONDITION_FAILED,
+        )
+
+    @app.errorhandler(StaleDataError)
+    def stale_data_412(error):
+        # an ORM flush found the row's version changed under it
+        db.session.rollback()
+        return precondition_failed_412(error)
+
     @app.errorhandler(HTTPStatus.UNPROCESSABLE_ENTITY)
     def unprocessable_entity_422(error):
         return (
@@ -237,6 +542,9 @@ def create_app(config=os.environ['APP_SETTINGS']):
             HTTPStatus.INTERNAL_SERVER_ERROR,
         )
 
+    # every route is defined by now, build the route / permission matrix once
+    app.extensions['permissions'] = auth.permissions.routes(app)
+
     return app
 
 
@@ -1,20 +1,60 @@
 import json
 import os
+import sys
+import time
 from functools import wraps
 from http import HTTPStatus
 from urllib.request import urlopen
 
-from flask import request
-from jose import jwt
+from flask import current_app, g, request
+from jose import JWTError, jwt
 
 from dotenv import load_dotenv
 
+from cache import Cache
+
 load_dotenv()
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.environ['AUTH0_AUDIENCE']
 
+# seconds the key set fetched from Auth0 is kept and the fetch may take
+JWKS_TTL = 600
+JWKS_TIMEOUT = 5
+
+jwks_cache = Cache('jwks', maxsize=1, ttl=JWKS_TTL, item_size=16384)
+# decoded payloads and their permission masks keyed by the raw token,
+# each kept until the token expires
+token_cache = Cache('tokens', maxsize=4096, item_size=1024)
+
+# permissions of the Auth0 roles, see README.md
+ROLE_PERMISSIONS = {
+    'casting_assistant': [
+        'get:actors',
+        'get:movies',
+    ],
+    'casting_director': [
+        'delete:actors',
+        'get:actors',
+        'get:movies',
+        'patch:actors',
+        'patch:movies',
+        'post:actors',
+    ],
+    'executive_producer': [
+        'delete:actors',
+        'delete:movies',
+        'get:actors',
+        'get:movies',
+        'patch:actors',
+        'patch:movies',
+        'post:actors',
+        'post:movies',
+        'get:runtime',
+    ],
+}
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -28,6 +68,64 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# Permission registry
+'''
+PermissionRegistry
+Every permission a route requires through @requires_auth is interned and
+given a bit when create_app defines the routes. A token's permissions are
+turned into one int mask once, when the token is first verified, and stored
+with its payload in token_cache, so checking a permission is a single AND
+'''
+
+
+class PermissionRegistry:
+    def __init__(self):
+        self.bits = {}
+        self._fingerprint = ''
+
+    def register(self, permission: str):
+        permission = sys.intern(permission)
+        if permission not in self.bits:
+            self.bits[permission] = 1 << len(self.bits)
+            self._fingerprint = ','.join(self.bits)
+        return self.bits[permission]
+
+    def mask(self, permissions):
+        mask = 0
+        for permission in permissions:
+            mask |= self.bits.get(permission, 0)
+        return mask
+
+    @property
+    def fingerprint(self):
+        """
+        Identifies the bit assignment, a mask cached under a different one
+        (e.g. in a shared cache written by an older deploy) is recomputed
+        """
+        return self._fingerprint
+
+    def routes(self, app):
+        """
+        The route -> permission -> roles matrix of app
+        """
+        matrix = []
+        for rule in sorted(app.url_map.iter_rules(), key=lambda rule: (rule.rule, sorted(rule.methods))):
+            view = app.view_functions.get(rule.endpoint)
+            permission = getattr(view, 'required_permission', None)
+            matrix.append({
+                'rule': rule.rule,
+                'methods': sorted(rule.methods - {'HEAD', 'OPTIONS'}),
+                'permission': permission,
+                'roles': None if permission is None else [
+                    role for role, granted in ROLE_PERMISSIONS.items() if permission in granted
+                ],
+            })
+        return matrix
+
+
+permissions = PermissionRegistry()
+
+
 # Auth Header
 
 '''
@@ -77,28 +175,28 @@ def get_token_auth_header():
 
 
 '''
-    check_permissions(permission, payload) method
+    check_permissions(permission_bit, permission_mask) method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
-        payload: decoded jwt payload
+        permission_bit: bit of the permission in the registry (permissions.register('post:drink'))
+        permission_mask: mask of the token's permissions, None if it has none
 
     it should raise an AuthError if permissions 
     are not included in the payload
     !!NOTE check your RBAC settings in Auth0
     it should raise an AuthError if the requested permission
-     string is not in the payload permissions array
+     bit is not set in the token's permission mask
     return true otherwise
 '''
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
+def check_permissions(permission_bit, permission_mask):
+    if permission_mask is None:
         raise AuthError({
             'code': 'invalid claims',
             'description': 'Permissions not in JWT'
         }, HTTPStatus.BAD_REQUEST)
 
-    if permission not in payload['permissions']:
+    if not permission_mask & permission_bit:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'User not allowed this permission'
@@ -106,6 +204,26 @@ def check_permissions(permission, payload):
     return True
 
 
+'''
+    get_jwks() method
+    return the JSON Web Key Set used to verify tokens
+    a key set placed in the AUTH0_JWKS config value (the tests use one)
+    takes precedence over the one published by Auth0
+    the one published by Auth0 is fetched once per JWKS_TTL, not per request
+'''
+
+
+def get_jwks():
+    jwks = current_app.config.get('AUTH0_JWKS')
+    if jwks is None:
+        jwks = jwks_cache.get('jwks')
+    if jwks is None:
+        jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json', timeout=JWKS_TIMEOUT)
+        jwks = json.loads(jsonurl.read())
+        jwks_cache.set('jwks', jwks)
+    return jwks
+
+
 '''
     verify_decode_jwt(token) method
     @INPUTS
@@ -121,9 +239,14 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
+    jwks = get_jwks()
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except JWTError:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, HTTPStatus.UNAUTHORIZED)
     rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
@@ -174,27 +297,61 @@ def verify_decode_jwt(token):
     }, HTTPStatus.BAD_REQUEST)
 
 
+'''
+    decode_token(token) method
+    @INPUTS
+        token: a json web token (string)
+
+    a token seen before is served from token_cache until it expires
+    otherwise it should use the verify_decode_jwt method to decode the jwt
+    return a dict with the decoded payload and the mask of its permissions
+'''
+
+
+def decode_token(token):
+    entry = token_cache.get(token)
+    if entry is not None and entry['exp'] > time.time() and entry['registry'] == permissions.fingerprint:
+        return entry
+
+    payload = verify_decode_jwt(token)
+    entry = {
+        'payload': payload,
+        'exp': payload.get('exp', 0),
+        'mask': permissions.mask(payload['permissions']) if 'permissions' in payload else None,
+        'registry': permissions.fingerprint,
+    }
+    if 'exp' in payload:
+        token_cache.set(token, entry, ttl=payload['exp'] - time.time())
+    return entry
+
+
 '''
     @requires_auth(permission) decorator method
     @INPUTS
         permission: string permission (i.e. 'post:drink')
 
+    it should register the permission in the permission registry
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
+    it should use the decode_token method to decode the jwt
     it should use the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
+    through flask.g.jwt_payload
 '''
 
 
 def requires_auth(permission=''):
+    permission_bit = permissions.register(permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            entry = decode_token(token)
+            check_permissions(permission_bit, entry['mask'])
+            g.jwt_payload = entry['payload']
             return f(*args, **kwargs)
 
+        wrapper.required_permission = permission
         return wrapper
 
     return requires_auth_decorator
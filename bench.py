@@ -0,0 +1,263 @@
+"""
+Benchmarks, run against the test database
+(DATABASE_URL_TEST, an in-memory SQLite database without it)
+
+    python bench.py mutations [--rounds 500]
+    python bench.py partitions [--movies 20000]
+    python bench.py encoding [--rows 100000]
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+
+import msgpack
+
+# testing points the app at TestingConfig, it must come before models
+from testing import get_app
+from encoding import pack_rows
+from flask import json as flask_json
+from models import db, delete_versioned, update_versioned, Actor, GenderEnum, Movie
+from partitions import create_movie_partitions, is_partitioned
+from sqlalchemy import event, text
+
+
+class RoundTrips:
+    """
+    Counts the round trips to the database: every statement plus the
+    COMMITs, and the BEGINs where the driver sends them on its own
+    (models.setup_sqlite already sends BEGIN as a statement on SQLite)
+    statements leaves BEGIN and COMMIT out
+    """
+
+    def __init__(self, engine):
+        self.count = 0
+        self.statements = 0
+        event.listen(engine, 'before_cursor_execute', self.statement)
+        event.listen(engine, 'commit', self.transaction)
+        if engine.dialect.name != 'sqlite':
+            event.listen(engine, 'begin', self.transaction)
+
+    def statement(self, connection, cursor, statement, *args):
+        self.count += 1
+        if statement != 'BEGIN':
+            self.statements += 1
+
+    def transaction(self, connection):
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+        self.statements = 0
+
+
+def insert_actors(rounds: int):
+    actors = [Actor(name=f'Actor {i}', age=30, gender='male') for i in range(rounds)]
+    db.session.add_all(actors)
+    db.session.commit()
+    keys = [actor.id for actor in actors]
+    db.session.remove()
+    return keys
+
+
+def orm_patch(key: int):
+    actor = Actor.query.get_or_404(key)
+    actor.age = 31
+    actor.update()
+
+
+def statement_patch(key: int):
+    update_versioned(Actor, key, {'age': 31})
+    db.session.commit()
+
+
+def orm_delete(key: int):
+    actor = Actor.query.get_or_404(key)
+    actor.delete()
+
+
+def statement_delete(key: int):
+    delete_versioned(Actor, key)
+    db.session.commit()
+
+
+def run(name: str, operation, keys: list, round_trips: RoundTrips):
+    round_trips.reset()
+    start = time.perf_counter()
+    for key in keys:
+        operation(key)
+        # a new session per operation, as per request
+        db.session.remove()
+    elapsed = time.perf_counter() - start
+    print(
+        f'{name:<18} {round_trips.statements / len(keys):>12.2f} '
+        f'{round_trips.count / len(keys):>12.2f} {elapsed / len(keys) * 1000:>10.3f}'
+    )
+
+
+def mutations(rounds: int):
+    """
+    PATCH and DELETE through the ORM (load, mutate, flush) against the single
+    statement paths the routes use
+    """
+    round_trips = RoundTrips(db.engine)
+    print(f'{db.engine.dialect.name}, {rounds} rounds')
+    print(f'{"path":<18} {"statements":>12} {"round trips":>12} {"ms / op":>10}')
+
+    for name, operation in (('orm patch', orm_patch), ('statement patch', statement_patch)):
+        keys = insert_actors(rounds)
+        run(name, operation, keys, round_trips)
+        Actor.query.filter(Actor.id.in_(keys)).delete(synchronize_session=False)
+        db.session.commit()
+
+    for name, operation in (('orm delete', orm_delete), ('statement delete', statement_delete)):
+        run(name, operation, insert_actors(rounds), round_trips)
+
+
+PARTITION_QUERIES = {
+    'movies of 2010': (
+        "SELECT * FROM movie WHERE release_date >= '2010-01-01' AND release_date < '2011-01-01'"
+    ),
+    # a literal id, a subquery's result would only prune at run time
+    'cast of a movie': 'SELECT * FROM job WHERE movie_id = {movie_id}',
+}
+
+
+def scanned_relations(plan: dict):
+    """The tables and partitions an EXPLAIN plan reads"""
+    relations = set()
+    if 'Relation Name' in plan:
+        relations.add(plan['Relation Name'])
+    for child in plan.get('Plans', ()):
+        relations |= scanned_relations(child)
+    return relations
+
+
+def partitions(movies: int):
+    """
+    Partition pruning of the GET /movies release date filters and of the job
+    lookups by movie, with and without enable_partition_pruning
+    Needs a Postgres test database migrated with PARTITIONED_STORAGE set
+    """
+    with db.engine.connect() as connection:
+        if db.engine.dialect.name != 'postgresql' or not is_partitioned(connection, 'job'):
+            print('needs a Postgres test database migrated with PARTITIONED_STORAGE=1')
+            return
+
+        # everything is rolled back at the end, the yearly partitions included
+        transaction = connection.begin()
+        create_movie_partitions(connection, 2000, 2021)
+        connection.execute(text(
+            "INSERT INTO actor (name, age, gender) "
+            "SELECT 'Actor ' || i, 20 + i % 50, 'male' FROM generate_series(1, 1000) i"
+        ))
+        connection.execute(text(
+            "INSERT INTO movie (title, release_date) "
+            "SELECT 'Movie ' || i, timestamp '2000-01-01' + (i % 8000) * interval '1 day' "
+            "FROM generate_series(1, :movies) i"
+        ), {'movies': movies})
+        connection.execute(text(
+            "INSERT INTO job (movie_id, actor_id) "
+            "SELECT movie.id, actor.id FROM movie "
+            "JOIN actor ON actor.id % 100 = movie.id % 100"
+        ))
+        connection.execute(text('ANALYZE actor, movie, job'))
+        movie_id = connection.execute(text('SELECT max(id) FROM movie')).scalar()
+
+        print(f'{movies} movies')
+        print(f'{"query":<18} {"pruning":>8} {"relations":>10} {"ms":>10}')
+        for name, query in PARTITION_QUERIES.items():
+            for pruning in ('on', 'off'):
+                connection.execute(text(f'SET LOCAL enable_partition_pruning = {pruning}'))
+                explained = connection.execute(
+                    text(f'EXPLAIN (ANALYZE, FORMAT JSON) {query.format(movie_id=movie_id)}')
+                ).scalar()[0]
+                relations = scanned_relations(explained['Plan'])
+                print(f'{name:<18} {pruning:>8} {len(relations):>10} {explained["Execution Time"]:>10.3f}')
+
+        transaction.rollback()
+
+
+def json_body(name: str, model):
+    """What GET /actors and GET /movies do for JSON"""
+    return flask_json.dumps({name: [row.serialize for row in model.query.order_by(model.id)]}).encode()
+
+
+def json_rows(name: str, data: bytes):
+    rows = json.loads(data)[name]
+    for row in rows:
+        if 'release_date' in row:
+            row['release_date'] = parsedate_to_datetime(row['release_date'])
+    return rows
+
+
+def msgpack_body(name: str, model):
+    """What they do for MessagePack"""
+    columns = [getattr(model, field) for field in model.fields]
+    return pack_rows(name, model.fields, db.session.query(*columns).order_by(model.id))
+
+
+def msgpack_rows(name: str, data: bytes):
+    return msgpack.unpackb(data, timestamp=3)[name]
+
+
+def timed(operation, *args):
+    start = time.perf_counter()
+    result = operation(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def encoding(rows: int):
+    """
+    Payload size, encode time (query included) and decode time (release dates
+    parsed back into datetimes) of the list routes' JSON and MessagePack bodies
+    """
+    released = datetime(2000, 1, 1)
+    db.session.execute(Actor.__table__.insert(), [
+        {'name': f'Actor {i}', 'age': 20 + i % 50, 'gender': GenderEnum(1 + i % 2)}
+        for i in range(rows)
+    ])
+    db.session.execute(Movie.__table__.insert(), [
+        {'title': f'Movie {i}', 'release_date': released + timedelta(hours=i)}
+        for i in range(rows)
+    ])
+
+    print(f'{db.engine.dialect.name}, {rows} rows')
+    print(f'{"body":<16} {"bytes":>12} {"encode ms":>10} {"decode ms":>10}')
+    for name, model in (('actors', Actor), ('movies', Movie)):
+        for encoder, decoder in ((json_body, json_rows), (msgpack_body, msgpack_rows)):
+            data, encode_ms = timed(encoder, name, model)
+            decoded, decode_ms = timed(decoder, name, data)
+            assert len(decoded) == rows
+            label = f'{name} {encoder.__name__.split("_")[0]}'
+            print(f'{label:<16} {len(data):>12} {encode_ms:>10.1f} {decode_ms:>10.1f}')
+
+    db.session.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_mutations = subparsers.add_parser('mutations', help=mutations.__doc__)
+    parser_mutations.add_argument('--rounds', type=int, default=500)
+
+    parser_partitions = subparsers.add_parser('partitions', help=partitions.__doc__)
+    parser_partitions.add_argument('--movies', type=int, default=20000)
+
+    parser_encoding = subparsers.add_parser('encoding', help=encoding.__doc__)
+    parser_encoding.add_argument('--rows', type=int, default=100000)
+
+    args = parser.parse_args()
+    with get_app().app_context():
+        if args.benchmark == 'mutations':
+            mutations(args.rounds)
+        elif args.benchmark == 'partitions':
+            partitions(args.movies)
+        elif args.benchmark == 'encoding':
+            encoding(args.rows)
+
+
+if __name__ == '__main__':
+    main()
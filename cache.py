@@ -0,0 +1,288 @@
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import stat
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# every cache registers itself here by name so /debug/runtime can report on it
+caches = {}
+
+
+class Cache:
+    """
+    A named cache, registered in caches
+    Entries live in a per process LRUCache until configure_caches moves them
+    to a SharedCache. Keeps hit and miss counts for the runtime statistics
+    item_size is the largest entry the shared backend has to hold
+    """
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = None, item_size: int = 1024):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.item_size = item_size
+        self.hits = 0
+        self.misses = 0
+        self.backend = LRUCache(maxsize)
+        caches[name] = self
+
+    def get(self, key, default=None):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        self.backend.set(key, value, self.ttl if ttl is None else ttl)
+
+    def clear(self):
+        self.backend.clear()
+
+    def __len__(self):
+        return len(self.backend)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'size': len(self.backend),
+            'maxsize': self.backend.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+        }
+
+
+class LRUCache:
+    """
+    Thread safe least recently used cache with an optional time to live
+    get returns None for a missing or expired key
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SharedCache:
+    """
+    Cache in a memory-mapped file, shared by every worker process on the host
+
+    The file is a header followed by fixed-size slots grouped in buckets of
+    WAYS slots. A key is hashed with blake2b, the digest picks the bucket and is
+    stored in place of the key; values are stored as JSON so only JSON-shaped
+    values (dicts, lists, strings, numbers) can be cached. A full bucket evicts
+    its least recently used slot, a value that doesn't fit in a slot isn't cached
+
+    Writers serialize on a lock of the file. Readers take no lock: every slot
+    starts with a sequence number a writer makes odd while it changes the slot
+    and even again when done, a reader that sees it odd or changed across its
+    copy of the slot tries again (a seqlock)
+
+    The geometry is part of the file name configure_caches picks, a file is
+    never resized under a worker that has it mapped
+    """
+    MAGIC = b'AGCACHE1'
+    HEADER = struct.Struct('<8sII')  # magic, slots, slot size
+    HEADER_SIZE = 64
+    # sequence, key digest, expires at (0 = never), last used, value length
+    SLOT = struct.Struct('<I4x16sddI')
+    SEQUENCE = struct.Struct('<I')
+    LAST_USED = struct.Struct('<d')
+    LAST_USED_OFFSET = 32
+    EMPTY = bytes(16)
+    WAYS = 8
+    READ_RETRIES = 16
+
+    def __init__(self, path: str, maxsize: int = 1024, slot_size: int = 1024):
+        self.path = path
+        self.buckets = max(1, -(-maxsize // self.WAYS))
+        self.maxsize = self.buckets * self.WAYS
+        self.slot_size = slot_size
+        self.capacity = slot_size - self.SLOT.size
+        self.file_size = self.HEADER_SIZE + self.maxsize * slot_size
+
+        self._thread_lock = threading.Lock()
+        self._lock_fd = None
+        self._lock_pid = None
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            check_private(path, os.fstat(fd), stat.S_ISREG)
+            with self._write_lock():
+                header = self.HEADER.pack(self.MAGIC, self.maxsize, slot_size)
+                if os.fstat(fd).st_size != self.file_size or os.pread(fd, self.HEADER.size, 0) != header:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, self.file_size)
+                    os.pwrite(fd, header, 0)
+            self._map = mmap.mmap(fd, self.file_size)
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def _write_lock(self):
+        # flock is held per open file, which a forked worker shares with its
+        # parent, so every process opens the file for locking itself
+        if self._lock_pid != os.getpid():
+            self._lock_fd = os.open(self.path, os.O_RDWR | os.O_NOFOLLOW)
+            self._lock_pid = os.getpid()
+        with self._thread_lock:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+
+    def _slots(self, digest: bytes):
+        bucket = int.from_bytes(digest[:8], 'little') % self.buckets
+        first = self.HEADER_SIZE + bucket * self.WAYS * self.slot_size
+        return range(first, first + self.WAYS * self.slot_size, self.slot_size)
+
+    def get(self, key):
+        digest = self._digest(key)
+        now = time.time()
+        for offset in self._slots(digest):
+            for _ in range(self.READ_RETRIES):
+                sequence, slot_digest, expires_at, _, length = self.SLOT.unpack_from(self._map, offset)
+                if sequence & 1:
+                    continue
+                if slot_digest != digest:
+                    break
+                start = offset + self.SLOT.size
+                data = self._map[start:start + length]
+                if self.SEQUENCE.unpack_from(self._map, offset)[0] != sequence:
+                    continue
+                if expires_at and expires_at <= now:
+                    return None
+                # racing a writer here only costs the slot some recency
+                self.LAST_USED.pack_into(self._map, offset + self.LAST_USED_OFFSET, now)
+                return json.loads(data)
+        return None
+
+    def set(self, key, value, ttl: float = None):
+        data = json.dumps(value, separators=(',', ':')).encode()
+        if len(data) > self.capacity:
+            return
+        digest = self._digest(key)
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else 0.0
+
+        with self._write_lock():
+            victim, victim_rank = None, None
+            for offset in self._slots(digest):
+                _, slot_digest, slot_expires_at, last_used, _ = self.SLOT.unpack_from(self._map, offset)
+                if slot_digest == digest:
+                    victim = offset
+                    break
+                free = slot_digest == self.EMPTY or (slot_expires_at and slot_expires_at <= now)
+                rank = (not free, last_used)
+                if victim_rank is None or rank < victim_rank:
+                    victim, victim_rank = offset, rank
+            self._write_slot(victim, digest, expires_at, now, data)
+
+    def _write_slot(self, offset: int, digest: bytes, expires_at: float, last_used: float, data: bytes):
+        sequence = self.SEQUENCE.unpack_from(self._map, offset)[0]
+        self.SEQUENCE.pack_into(self._map, offset, (sequence + 1) & 0xFFFFFFFF)
+        start = offset + self.SLOT.size
+        self._map[start:start + len(data)] = data
+        self.SLOT.pack_into(self._map, offset, (sequence + 1) & 0xFFFFFFFF, digest, expires_at, last_used, len(data))
+        self.SEQUENCE.pack_into(self._map, offset, (sequence + 2) & 0xFFFFFFFF)
+
+    def clear(self):
+        with self._write_lock():
+            for offset in range(self.HEADER_SIZE, self.file_size, self.slot_size):
+                self._write_slot(offset, self.EMPTY, 0.0, 0.0, b'')
+
+    def __len__(self):
+        now = time.time()
+        size = 0
+        for offset in range(self.HEADER_SIZE, self.file_size, self.slot_size):
+            _, slot_digest, expires_at, _, _ = self.SLOT.unpack_from(self._map, offset)
+            if slot_digest != self.EMPTY and not (expires_at and expires_at <= now):
+                size += 1
+        return size
+
+
+def check_private(path: str, status: os.stat_result, is_type):
+    """
+    Raises PermissionError unless path is of the type is_type checks for
+    (stat.S_ISDIR, stat.S_ISREG), owned by this user and closed to everyone
+    else. Entries of token_cache aren't verified again, whoever can write a
+    cache file can hand any token any permission
+    """
+    if not is_type(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+        raise PermissionError(f'{path} is not private to this user')
+
+
+def configure_caches(app):
+    """
+    Points every registered cache at the backend named by CACHE_BACKEND
+        memory: a LRUCache per worker process (the default)
+        shared: a SharedCache file per cache in CACHE_DIR, shared by the
+                workers on the host
+    CACHE_DIR usually sits in a directory every user can write to, if it or
+    a file in it isn't private to this user the caches stay per worker
+    """
+    if app.config.get('CACHE_BACKEND', 'memory') != 'shared':
+        return
+
+    directory = app.config['CACHE_DIR']
+    backends = {}
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # lstat, a symlink to someone else's directory isn't private either
+        check_private(directory, os.lstat(directory), stat.S_ISDIR)
+        for name, cache in caches.items():
+            if isinstance(cache.backend, SharedCache):
+                continue
+            path = os.path.join(directory, f'{name}-{cache.maxsize}x{cache.item_size}.cache')
+            backends[name] = SharedCache(path, cache.maxsize, slot_size=SharedCache.SLOT.size + cache.item_size)
+    except OSError as e:
+        logger.warning('CACHE_BACKEND=shared refused, caches stay per worker: %s', e)
+        return
+
+    for name, backend in backends.items():
+        caches[name].backend = backend
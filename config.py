@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -19,6 +20,32 @@ class Config(object):
     CSRF_ENABLED = True
     SECRET_KEY = 'this-really-needs-to-be-changed'
     SQLALCHEMY_DATABASE_URI = get_database_url('DATABASE_URL')
+    # longest /readyz waits for the database to answer, connecting included
+    READINESS_TIMEOUT_MS = 1000
+    # Postgres only, seconds to wait for a new connection before giving up
+    DATABASE_CONNECT_TIMEOUT = 5
+    # Postgres only, have the migrations partition job and movie (see partitions.py)
+    PARTITIONED_STORAGE = os.getenv('PARTITIONED_STORAGE', '') not in ('', '0', 'false')
+    # seconds a stored Idempotency-Key response is replayed for
+    IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+    # off, log or raise when a request runs more statements than its route's
+    # @query_budget, or the same statement more than QUERY_REPEAT_LIMIT times
+    QUERY_BUDGET_MODE = os.getenv('QUERY_BUDGET_MODE', 'off')
+    QUERY_REPEAT_LIMIT = 5
+    # share of the requests profiled at random (0 to 1), and how often the
+    # profiler samples their stacks, see profiler.py
+    PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+    PROFILE_INTERVAL_MS = 10
+    # most ids GET /actors?ids= and POST /movies/batch-get take, and how many go in one query
+    BATCH_MAX_IDS = 10000
+    BATCH_CHUNK_SIZE = 1000
+    # memory: every worker keeps its own caches
+    # shared: one memory-mapped file per cache in CACHE_DIR for all workers on the host
+    CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory')
+    CACHE_DIR = os.getenv(
+        'CACHE_DIR',
+        '/dev/shm/agency-cache' if os.path.isdir('/dev/shm') else os.path.join(tempfile.gettempdir(), 'agency-cache')
+    )
 
 
 class ProductionConfig(Config):
@@ -28,13 +55,17 @@ class ProductionConfig(Config):
 class StagingConfig(Config):
     DEVELOPMENT = True
     DEBUG = True
+    QUERY_BUDGET_MODE = os.getenv('QUERY_BUDGET_MODE', 'log')
 
 
 class DevelopmentConfig(Config):
     DEVELOPMENT = True
     DEBUG = True
+    QUERY_BUDGET_MODE = os.getenv('QUERY_BUDGET_MODE', 'log')
 
 
 class TestingConfig(Config):
     TESTING = True
-    SQLALCHEMY_DATABASE_URI = get_database_url('DATABASE_URL_TEST')
+    # without DATABASE_URL_TEST the tests run against an in-memory SQLite database
+    SQLALCHEMY_DATABASE_URI = get_database_url('DATABASE_URL_TEST') or 'sqlite://'
+    QUERY_BUDGET_MODE = 'raise'
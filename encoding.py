@@ -0,0 +1,59 @@
+import calendar
+import enum
+from datetime import datetime
+from operator import attrgetter
+
+import msgpack
+from flask import Response, request
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+# the name clients used before application/msgpack was registered
+X_MSGPACK = 'application/x-msgpack'
+
+'''
+MessagePack responses for the list routes, negotiated through Accept
+
+JSON stays the default, a client gets MessagePack by preferring it:
+    Accept: application/msgpack
+The body is a map holding the column names once and every row as an array:
+    {"columns": ["id", "title", ...], "movies": [[1, "Up", ...], ...]}
+enums are sent as their integer value (GenderEnum.male is 1) and datetimes as
+MessagePack timestamps (extension type -1) in UTC, which msgpack.unpackb
+turns back into datetimes with timestamp=3
+'''
+
+
+def wants_msgpack():
+    best = request.accept_mimetypes.best_match([JSON, MSGPACK, X_MSGPACK], default=JSON)
+    return best != JSON
+
+
+def pack_default(value):
+    """Packs what MessagePack has no type for, msgpack calls it for nothing else"""
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, datetime):
+        # the models store naive UTC datetimes
+        return msgpack.Timestamp(calendar.timegm(value.utctimetuple()), value.microsecond * 1000)
+    raise TypeError(f'{type(value).__name__} can not be packed')
+
+
+def pack_rows(name: str, columns: tuple, rows, **extra):
+    """
+    rows are tuples in the order of columns, such as the rows of a query
+    for the columns themselves, extra goes into the body as is
+    """
+    body = {'columns': list(columns), name: [tuple(row) for row in rows], **extra}
+    return msgpack.packb(body, default=pack_default)
+
+
+def pack_models(name: str, columns: tuple, models: list, **extra):
+    """pack_rows for models already loaded"""
+    return pack_rows(name, columns, map(attrgetter(*columns), models), **extra)
+
+
+def msgpack_response(data: bytes):
+    response = Response(data, mimetype=MSGPACK)
+    response.vary.add('Accept')
+    return response
@@ -0,0 +1,153 @@
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+from http import HTTPStatus
+
+from flask import Response, abort, current_app, g, make_response, request
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from models import db, IdempotencyKey
+from querybudget import extend_query_budget
+
+'''
+    @idempotent decorator method
+
+    goes below @requires_auth, which puts the token payload in flask.g
+    without an Idempotency-Key header the route runs as usual
+    with one, the first request claims the key for the token's subject and
+    its response is stored; a retry with the same key gets the stored response
+    back (with an Idempotent-Replayed header) without running the route again
+
+    the claim is only committed with the stored response, a retry while the
+    first request is still running waits on the key's unique constraint and
+    then gets the stored response (or claims the key if the first one failed)
+    a claimed key without a response -> 409 error response
+    a key reused with a different request body -> 422 error response
+    keys expire after IDEMPOTENCY_KEY_TTL seconds
+'''
+
+
+def idempotent(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return f(*args, **kwargs)
+        if not key or len(key) > 255:
+            abort(HTTPStatus.BAD_REQUEST)
+
+        subject = g.jwt_payload.get('sub', '')
+        request_hash = hashlib.sha256(request.get_data()).digest()
+
+        if not claim_key(key, subject, request_hash):
+            stored = find_key(key, subject)
+            if stored is not None and stored.expires_at <= datetime.utcnow():
+                # expired but not collected yet, it doesn't count
+                # find, release and the second claim come on top of the route's
+                # usual claim, INSERT and UPDATE, the claim runs twice
+                extend_query_budget(3, repeats=1)
+                release_key(key, subject)
+                stored = None if claim_key(key, subject, request_hash) else find_key(key, subject)
+            if stored is not None:
+                return replay(stored, request_hash)
+
+        try:
+            # the route's commit only releases this savepoint, what it writes
+            # is committed below together with the claim and the response, a
+            # crash in between leaves no claimed key without a response
+            savepoint = db.session.begin_nested()
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            # nothing to replay, let a retry run the route again
+            db.session.rollback()
+            release_key(key, subject)
+            raise
+
+        if savepoint.is_active:
+            savepoint.commit()
+        db.session.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == key, IdempotencyKey.subject == subject)
+            .values(status_code=response.status_code, response=response.get_data(as_text=True))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        return response
+
+    return wrapper
+
+
+def claim_key(key: str, subject: str, request_hash: bytes):
+    """
+    Inserts the key unless the subject already has it, returns whether it did
+    The unique constraint on (key, subject) decides between concurrent
+    requests, there is no lock. INSERT ... ON CONFLICT DO NOTHING on Postgres
+    and SQLite, a savepoint around a plain INSERT elsewhere
+    """
+    values = {
+        'key': key,
+        'subject': subject,
+        'request_hash': request_hash,
+        'expires_at': datetime.utcnow() + timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL']),
+    }
+
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        statement = insert(IdempotencyKey).values(**values).on_conflict_do_nothing()
+        return db.session.execute(statement).rowcount == 1
+
+    try:
+        with db.session.begin_nested():
+            db.session.add(IdempotencyKey(**values))
+        return True
+    except IntegrityError:
+        return False
+
+
+def find_key(key: str, subject: str):
+    return IdempotencyKey.query.filter_by(key=key, subject=subject).first()
+
+
+def release_key(key: str, subject: str):
+    db.session.execute(
+        delete(IdempotencyKey)
+        .where(IdempotencyKey.key == key, IdempotencyKey.subject == subject)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def replay(stored: IdempotencyKey, request_hash: bytes):
+    if bytes(stored.request_hash) != request_hash:
+        abort(HTTPStatus.UNPROCESSABLE_ENTITY)
+    if stored.status_code is None:
+        abort(HTTPStatus.CONFLICT)
+
+    response = Response(stored.response, status=stored.status_code, mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def purge_expired_keys(batch_size: int = 1000):
+    """
+    Deletes expired keys batch_size rows per transaction so the table is never
+    locked for long, returns the number of keys deleted
+    """
+    deleted = 0
+    while True:
+        batch = select(IdempotencyKey.id) \
+            .where(IdempotencyKey.expires_at <= datetime.utcnow()) \
+            .limit(batch_size) \
+            .scalar_subquery()
+        result = db.session.execute(
+            delete(IdempotencyKey)
+            .where(IdempotencyKey.id.in_(batch))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
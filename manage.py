@@ -1,13 +1,42 @@
+from datetime import datetime
+
 from flask_migrate import Migrate, MigrateCommand
 from flask_script import Manager
 
 from app import APP
-from models import db
+from idempotency import purge_expired_keys
+from models import db, recompute_counters
+from partitions import create_movie_partitions, is_partitioned
 
 migrate = Migrate(APP, db)
 manager = Manager(APP)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def recount():
+    """Recompute the movie cast_count and actor movie_count columns"""
+    recompute_counters()
+
+
+@manager.option('--batch-size', dest='batch_size', type=int, default=1000)
+def purge_idempotency_keys(batch_size):
+    """Delete expired Idempotency-Key responses in batches"""
+    print(f'{purge_expired_keys(batch_size)} expired keys deleted')
+
+
+@manager.option('--years-ahead', dest='years_ahead', type=int, default=2)
+def partition_movies(years_ahead):
+    """Create the yearly movie partitions up to years_ahead years from now"""
+    with db.engine.begin() as connection:
+        if not is_partitioned(connection, 'movie'):
+            print('movie is not partitioned')
+            return
+        this_year = datetime.utcnow().year
+        for name in create_movie_partitions(connection, this_year, this_year + years_ahead):
+            print(f'created {name}')
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,60 @@
+"""add cast and movie counters
+
+Revision ID: 3f2a9c1d7e01
+Revises:
+Create Date: 2026-10-19 09:12:40.183512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from models import POSTGRES_JOB_COUNTERS, SQLITE_JOB_COUNTERS
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7e01'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # setup_db's create_all already adds the columns (and the triggers) to a
+    # new database as soon as the app is imported, manage.py included
+    inspector = sa.inspect(op.get_bind())
+    if 'cast_count' not in {column['name'] for column in inspector.get_columns('movie')}:
+        op.add_column('movie', sa.Column('cast_count', sa.Integer(), server_default='0', nullable=False))
+        op.create_index(op.f('ix_movie_cast_count'), 'movie', ['cast_count'], unique=False)
+    if 'movie_count' not in {column['name'] for column in inspector.get_columns('actor')}:
+        op.add_column('actor', sa.Column('movie_count', sa.Integer(), server_default='0', nullable=False))
+        op.create_index(op.f('ix_actor_movie_count'), 'actor', ['movie_count'], unique=False)
+
+    # backfill from the existing jobs before the triggers take over
+    op.execute(
+        'UPDATE movie SET cast_count = '
+        '(SELECT count(*) FROM job WHERE job.movie_id = movie.id)'
+    )
+    op.execute(
+        'UPDATE actor SET movie_count = '
+        '(SELECT count(*) FROM job WHERE job.actor_id = actor.id)'
+    )
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute(POSTGRES_JOB_COUNTERS)
+    else:
+        for statement in SQLITE_JOB_COUNTERS:
+            op.execute(statement)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP TRIGGER IF EXISTS job_counters ON job')
+        op.execute('DROP FUNCTION IF EXISTS job_counters()')
+    else:
+        for name in ('job_counters_insert', 'job_counters_delete', 'job_counters_update'):
+            op.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+    op.drop_index(op.f('ix_actor_movie_count'), table_name='actor')
+    op.drop_index(op.f('ix_movie_cast_count'), table_name='movie')
+    op.drop_column('actor', 'movie_count')
+    op.drop_column('movie', 'cast_count')
@@ -0,0 +1,30 @@
+"""add version columns
+
+Revision ID: 8b41d0e6c2a7
+Revises: 3f2a9c1d7e01
+Create Date: 2026-10-19 10:03:17.552410
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b41d0e6c2a7'
+down_revision = '3f2a9c1d7e01'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # setup_db's create_all already adds them to a new database
+    inspector = sa.inspect(op.get_bind())
+    for table in ('actor', 'movie', 'job'):
+        if 'version' not in {column['name'] for column in inspector.get_columns(table)}:
+            op.add_column(table, sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('job', 'version')
+    op.drop_column('movie', 'version')
+    op.drop_column('actor', 'version')
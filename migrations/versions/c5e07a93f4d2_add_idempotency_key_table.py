@@ -0,0 +1,42 @@
+"""add idempotency_key table
+
+Revision ID: c5e07a93f4d2
+Revises: 8b41d0e6c2a7
+Create Date: 2026-10-19 11:26:05.911354
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e07a93f4d2'
+down_revision = '8b41d0e6c2a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # setup_db's create_all creates it as soon as the app is imported,
+    # manage.py included
+    if sa.inspect(op.get_bind()).has_table('idempotency_key'):
+        return
+
+    op.create_table(
+        'idempotency_key',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('subject', sa.String(length=255), nullable=False),
+        sa.Column('request_hash', sa.LargeBinary(length=32), nullable=False),
+        sa.Column('status_code', sa.SmallInteger(), nullable=True),
+        sa.Column('response', sa.Text(), nullable=True),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('key', 'subject')
+    )
+    op.create_index(op.f('ix_idempotency_key_expires_at'), 'idempotency_key', ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_idempotency_key_expires_at'), table_name='idempotency_key')
+    op.drop_table('idempotency_key')
@@ -0,0 +1,49 @@
+"""partition job and movie
+
+Revision ID: e94b7c2d5a18
+Revises: c5e07a93f4d2
+Create Date: 2026-10-19 13:41:52.270661
+
+Only converts the tables on Postgres with PARTITIONED_STORAGE set,
+see partitions.py. Otherwise this revision changes nothing
+"""
+from alembic import op
+from flask import current_app
+
+from models import POSTGRES_JOB_COUNTERS
+from partitions import (
+    DROP_MOVIE_JOB_TRIGGERS,
+    MOVIE_JOB_TRIGGERS,
+    is_partitioned,
+    partition_tables,
+    unpartition_tables
+)
+
+
+# revision identifiers, used by Alembic.
+revision = 'e94b7c2d5a18'
+down_revision = 'c5e07a93f4d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    connection = op.get_bind()
+    if connection.dialect.name != 'postgresql' or not current_app.config['PARTITIONED_STORAGE']:
+        return
+    if is_partitioned(connection, 'job'):
+        return
+
+    partition_tables(connection)
+    op.execute(POSTGRES_JOB_COUNTERS)
+    op.execute(MOVIE_JOB_TRIGGERS)
+
+
+def downgrade():
+    connection = op.get_bind()
+    if connection.dialect.name != 'postgresql' or not is_partitioned(connection, 'job'):
+        return
+
+    op.execute(DROP_MOVIE_JOB_TRIGGERS)
+    unpartition_tables(connection)
+    op.execute(POSTGRES_JOB_COUNTERS)
@@ -4,16 +4,38 @@ from datetime import datetime
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import (
+    ARRAY,
+    DDL,
     Column,
     String,
     Integer,
+    SmallInteger,
+    Text,
+    LargeBinary,
     Enum,
     DateTime,
-    ForeignKey
+    ForeignKey,
+    UniqueConstraint,
+    any_,
+    bindparam,
+    delete,
+    event,
+    func,
+    select,
+    update
 )
 
 db = SQLAlchemy()
 
+# range of the Integer columns, Postgres refuses values outside it and the
+# SQLite driver can't bind them
+INTEGER_MIN = -2 ** 31
+INTEGER_MAX = 2 ** 31 - 1
+
+
+def fits_integer(value: int):
+    return INTEGER_MIN <= value <= INTEGER_MAX
+
 
 def setup_db(app):
     """
@@ -21,12 +43,41 @@ def setup_db(app):
         binds a flask application and a SQLAlchemy service
     """
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    if app.config["SQLALCHEMY_DATABASE_URI"].startswith('postgresql'):
+        # libpq otherwise waits as long as the OS does for an unreachable host
+        options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+        options.setdefault('connect_args', {}).setdefault(
+            'connect_timeout', app.config.get('DATABASE_CONNECT_TIMEOUT', 5)
+        )
     db.app = app
     db.init_app(app)
+
+    engine = db.get_engine(app)
+    if engine.dialect.name == 'sqlite':
+        setup_sqlite(engine)
+
     db.create_all()
     Migrate(app, db)
 
 
+def setup_sqlite(engine):
+    """
+    setup_sqlite(engine)
+        SQLite leaves foreign keys off (so no ondelete='CASCADE') and pysqlite
+        manages transactions itself which breaks SAVEPOINT, which the tests use.
+        Turn the first on and take over BEGIN from the driver
+    """
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+
 class GenderEnum(enum.Enum):
     """
     constraint gender to be one of:
@@ -62,7 +113,15 @@ class Actor(db.Model):
     name = Column(String)
     age = Column(Integer)
     gender = Column(Enum(GenderEnum))
-    movies = db.relationship('Job', backref='movie', lazy=True)
+    # number of job rows referencing this actor, maintained by the job triggers
+    movie_count = Column(Integer, nullable=False, default=0, server_default='0', index=True)
+    # bumped on every update, exposed as the ETag checked against If-Match
+    version = Column(Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+    # what serialize returns, in the order of the MessagePack rows
+    fields = ('id', 'name', 'age', 'gender', 'movie_count', 'version')
+    movies = db.relationship('Job', backref='movie', lazy=True, passive_deletes=True)
 
     def __init__(self, name: str, age: int, gender: str):
         self.name = name
@@ -90,7 +149,9 @@ class Actor(db.Model):
             'id': self.id,
             'name': self.name,
             'age': self.age,
-            'gender': GenderEnum.reverse_transform(self.gender)
+            'gender': GenderEnum.reverse_transform(self.gender),
+            'movie_count': self.movie_count,
+            'version': self.version
         }
 
 
@@ -102,7 +163,14 @@ class Movie(db.Model):
     id = Column(Integer, primary_key=True)
     title = Column(String)
     release_date = Column(DateTime, default=datetime.utcnow)
-    actors = db.relationship('Job', backref='actor', lazy=True)
+    # number of job rows referencing this movie, maintained by the job triggers
+    cast_count = Column(Integer, nullable=False, default=0, server_default='0', index=True)
+    # bumped on every update, exposed as the ETag checked against If-Match
+    version = Column(Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+    fields = ('id', 'title', 'release_date', 'cast_count', 'version')
+    actors = db.relationship('Job', backref='actor', lazy=True, passive_deletes=True)
 
     def __init__(self, title: str, release_date: datetime = datetime.utcnow()):
         self.title = title
@@ -128,6 +196,8 @@ class Movie(db.Model):
             'id': self.id,
             'title': self.title,
             'release_date': self.release_date,
+            'cast_count': self.cast_count,
+            'version': self.version
         }
 
 
@@ -139,6 +209,10 @@ class Job(db.Model):
     id = Column(Integer, primary_key=True)
     movie_id = Column(Integer, ForeignKey('movie.id', ondelete='CASCADE'), nullable=False)
     actor_id = Column(Integer, ForeignKey('actor.id', ondelete='CASCADE'), nullable=False)
+    # bumped on every update, exposed as the ETag checked against If-Match
+    version = Column(Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, movie_id: int, actor_id: int):
         self.movie_id = movie_id
@@ -157,3 +231,191 @@ class Job(db.Model):
 
     def format(self):
         return f'ActingJob: \n{vars(self)}'
+
+
+class IdempotencyKey(db.Model):
+    """
+    Response stored for a POST sent with an Idempotency-Key header,
+    replayed when the same subject retries it with the same key
+    """
+    __tablename__ = 'idempotency_key'
+    __table_args__ = (UniqueConstraint('key', 'subject'),)
+    id = Column(Integer, primary_key=True)
+    key = Column(String(255), nullable=False)
+    # sub claim of the token that sent the request
+    subject = Column(String(255), nullable=False)
+    # sha256 of the request body, a retry has to send the same one
+    request_hash = Column(LargeBinary(32), nullable=False)
+    # both null while the first request is still running
+    status_code = Column(SmallInteger)
+    response = Column(Text)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+
+    def format(self):
+        return f'IdempotencyKey: \n{vars(self)}'
+
+
+def update_versioned(model, key: int, values: dict, versions: list = None):
+    """
+    update_versioned(model, key, values, versions)
+        sets values on the row with primary key key and bumps its version using
+        a single UPDATE ... WHERE id = key [AND version IN versions], the row is
+        not loaded first. Returns the new version, None if no row matched
+    """
+    statement = update(model) \
+        .where(model.id == key) \
+        .values(version=model.version + 1, **values) \
+        .execution_options(synchronize_session=False)
+    if versions is not None:
+        statement = statement.where(model.version.in_(versions))
+
+    if db.engine.dialect.full_returning:
+        return db.session.execute(statement.returning(model.version)).scalar()
+
+    # no UPDATE ... RETURNING (SQLite), read the new version back
+    if db.session.execute(statement).rowcount == 0:
+        return None
+    return db.session.execute(select(model.version).where(model.id == key)).scalar()
+
+
+def delete_versioned(model, key: int, versions: list = None):
+    """
+    delete_versioned(model, key, versions)
+        deletes the row with primary key key using a single
+        DELETE ... WHERE id = key [AND version IN versions], the row is not
+        loaded first and dependent jobs are left to ondelete='CASCADE'.
+        Returns whether a row was deleted
+    """
+    statement = delete(model) \
+        .where(model.id == key) \
+        .execution_options(synchronize_session=False)
+    if versions is not None:
+        statement = statement.where(model.version.in_(versions))
+    return db.session.execute(statement).rowcount > 0
+
+
+def get_many(model, keys: list, chunk_size: int):
+    """
+    get_many(model, keys, chunk_size)
+        loads the rows with the given primary keys, one query per chunk_size
+        keys: WHERE id = ANY(:keys) with one array parameter on Postgres, so
+        the statement is the same whatever the number of keys, and
+        WHERE id IN (...) elsewhere. Returns {key: row}
+    """
+    rows = {}
+    postgres = db.engine.dialect.name == 'postgresql'
+    for start in range(0, len(keys), chunk_size):
+        chunk = keys[start:start + chunk_size]
+        if postgres:
+            condition = model.id == any_(bindparam('keys', chunk, type_=ARRAY(Integer)))
+        else:
+            condition = model.id.in_(chunk)
+        for row in model.query.filter(condition):
+            rows[row.id] = row
+    return rows
+
+
+def row_exists(model, key: int):
+    """Whether a row with primary key key exists, without loading it"""
+    return db.session.execute(select(model.id).where(model.id == key)).first() is not None
+
+
+# Denormalized counters
+#
+# movie.cast_count and actor.movie_count are kept in step with the job table
+# by database triggers rather than ORM events, so they stay correct for rows
+# removed through ondelete='CASCADE' and for bulk statements that bypass the
+# session. The DDL below is attached to the job table so create_all installs
+# it; migrations/versions/ carries the same statements for existing databases.
+
+POSTGRES_JOB_COUNTERS = """
+CREATE OR REPLACE FUNCTION job_counters() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE movie SET cast_count = cast_count - 1 WHERE id = OLD.movie_id;
+        UPDATE actor SET movie_count = movie_count - 1 WHERE id = OLD.actor_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE movie SET cast_count = cast_count + 1 WHERE id = NEW.movie_id;
+        UPDATE actor SET movie_count = movie_count + 1 WHERE id = NEW.actor_id;
+        RETURN NEW;
+    END IF;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS job_counters ON job;
+CREATE TRIGGER job_counters
+AFTER INSERT OR DELETE OR UPDATE OF movie_id, actor_id ON job
+FOR EACH ROW EXECUTE PROCEDURE job_counters();
+"""
+
+SQLITE_JOB_COUNTERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS job_counters_insert AFTER INSERT ON job
+    BEGIN
+        UPDATE movie SET cast_count = cast_count + 1 WHERE id = NEW.movie_id;
+        UPDATE actor SET movie_count = movie_count + 1 WHERE id = NEW.actor_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS job_counters_delete AFTER DELETE ON job
+    BEGIN
+        UPDATE movie SET cast_count = cast_count - 1 WHERE id = OLD.movie_id;
+        UPDATE actor SET movie_count = movie_count - 1 WHERE id = OLD.actor_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS job_counters_update AFTER UPDATE OF movie_id, actor_id ON job
+    BEGIN
+        UPDATE movie SET cast_count = cast_count - 1 WHERE id = OLD.movie_id;
+        UPDATE actor SET movie_count = movie_count - 1 WHERE id = OLD.actor_id;
+        UPDATE movie SET cast_count = cast_count + 1 WHERE id = NEW.movie_id;
+        UPDATE actor SET movie_count = movie_count + 1 WHERE id = NEW.actor_id;
+    END
+    """,
+]
+
+event.listen(
+    Job.__table__,
+    'after_create',
+    DDL(POSTGRES_JOB_COUNTERS).execute_if(dialect='postgresql')
+)
+for statement in SQLITE_JOB_COUNTERS:
+    event.listen(
+        Job.__table__,
+        'after_create',
+        DDL(statement).execute_if(dialect='sqlite')
+    )
+
+
+def recompute_counters():
+    """
+    Recompute movie.cast_count and actor.movie_count from the job table
+    Two set-based UPDATE statements, used to repair drift after manual edits
+    or after restoring data with the triggers disabled
+    """
+    cast_count = select(func.count(Job.id)) \
+        .where(Job.movie_id == Movie.id) \
+        .scalar_subquery()
+    movie_count = select(func.count(Job.id)) \
+        .where(Job.actor_id == Actor.id) \
+        .scalar_subquery()
+
+    db.session.execute(
+        update(Movie).values(cast_count=cast_count),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.execute(
+        update(Actor).values(movie_count=movie_count),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
@@ -0,0 +1,205 @@
+from datetime import datetime
+
+from sqlalchemy import text
+
+'''
+Partitioned storage (Postgres only, opt-in with PARTITIONED_STORAGE=1)
+
+job is partitioned by hash of movie_id into JOB_PARTITIONS partitions, so the
+jobs of a movie (cascade deletes, Movie.actors) live in one partition.
+movie is partitioned by range of release_date, a partition per year plus a
+default partition for anything outside them, so release date filters on
+GET /movies only read the matching years.
+
+A primary key or unique constraint of a partitioned table has to include the
+partition key, so movie's primary key becomes (id, release_date) and ids stay
+unique through the sequence only. Nothing can reference movie (id) with a
+foreign key any more: the triggers below take over job.movie_id's
+ondelete='CASCADE' and its existence check. Unlike a real foreign key the
+check doesn't lock the movie, a job inserted while its movie is being deleted
+in another transaction can survive it; the casting routes don't do that.
+
+The migration in migrations/versions/ converts the tables, this module holds
+the statements it and manage.py use.
+'''
+
+JOB_PARTITIONS = 16
+
+PARTITION_MOVIE = """
+ALTER TABLE movie RENAME TO movie_unpartitioned;
+ALTER TABLE movie_unpartitioned RENAME CONSTRAINT movie_pkey TO movie_unpartitioned_pkey;
+ALTER INDEX ix_movie_cast_count RENAME TO ix_movie_unpartitioned_cast_count;
+
+CREATE TABLE movie (
+    id integer NOT NULL DEFAULT nextval('movie_id_seq'),
+    title varchar,
+    release_date timestamp NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    cast_count integer NOT NULL DEFAULT 0,
+    version integer NOT NULL DEFAULT 1,
+    CONSTRAINT movie_pkey PRIMARY KEY (id, release_date)
+) PARTITION BY RANGE (release_date);
+
+CREATE TABLE movie_default PARTITION OF movie DEFAULT;
+CREATE INDEX ix_movie_id ON movie (id);
+CREATE INDEX ix_movie_cast_count ON movie (cast_count);
+"""
+
+COPY_MOVIE = """
+INSERT INTO movie (id, title, release_date, cast_count, version)
+SELECT id, title, coalesce(release_date, now() AT TIME ZONE 'utc'), cast_count, version
+FROM movie_unpartitioned;
+ALTER SEQUENCE movie_id_seq OWNED BY movie.id;
+"""
+
+PARTITION_JOB = """
+ALTER TABLE job RENAME TO job_unpartitioned;
+ALTER TABLE job_unpartitioned RENAME CONSTRAINT job_pkey TO job_unpartitioned_pkey;
+DROP TRIGGER IF EXISTS job_counters ON job_unpartitioned;
+
+CREATE TABLE job (
+    id integer NOT NULL DEFAULT nextval('job_id_seq'),
+    movie_id integer NOT NULL,
+    actor_id integer NOT NULL REFERENCES actor (id) ON DELETE CASCADE,
+    version integer NOT NULL DEFAULT 1,
+    CONSTRAINT job_pkey PRIMARY KEY (id, movie_id)
+) PARTITION BY HASH (movie_id);
+
+CREATE INDEX ix_job_movie_id ON job (movie_id);
+CREATE INDEX ix_job_actor_id ON job (actor_id);
+""" + ''.join(
+    f"CREATE TABLE job_p{remainder} PARTITION OF job "
+    f"FOR VALUES WITH (MODULUS {JOB_PARTITIONS}, REMAINDER {remainder});\n"
+    for remainder in range(JOB_PARTITIONS)
+)
+
+COPY_JOB = """
+INSERT INTO job (id, movie_id, actor_id, version)
+SELECT id, movie_id, actor_id, version FROM job_unpartitioned;
+ALTER SEQUENCE job_id_seq OWNED BY job.id;
+DROP TABLE job_unpartitioned;
+DROP TABLE movie_unpartitioned;
+"""
+
+# job.movie_id's foreign key, as triggers
+MOVIE_JOB_TRIGGERS = """
+CREATE OR REPLACE FUNCTION movie_delete_jobs() RETURNS trigger AS $$
+BEGIN
+    -- an UPDATE moving a movie to another partition runs as a DELETE and an
+    -- INSERT and fires this too, the movie still exists then
+    IF NOT EXISTS (SELECT 1 FROM movie WHERE id = OLD.id) THEN
+        DELETE FROM job WHERE movie_id = OLD.id;
+    END IF;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER movie_delete_jobs
+AFTER DELETE ON movie
+FOR EACH ROW EXECUTE PROCEDURE movie_delete_jobs();
+
+CREATE OR REPLACE FUNCTION job_check_movie() RETURNS trigger AS $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM movie WHERE id = NEW.movie_id) THEN
+        RAISE foreign_key_violation
+        USING MESSAGE = 'movie ' || NEW.movie_id || ' referenced by job ' || NEW.id || ' does not exist';
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER job_check_movie
+AFTER INSERT OR UPDATE OF movie_id ON job
+FOR EACH ROW EXECUTE PROCEDURE job_check_movie();
+"""
+
+DROP_MOVIE_JOB_TRIGGERS = """
+DROP TRIGGER IF EXISTS movie_delete_jobs ON movie;
+DROP FUNCTION IF EXISTS movie_delete_jobs();
+DROP TRIGGER IF EXISTS job_check_movie ON job;
+DROP FUNCTION IF EXISTS job_check_movie();
+"""
+
+# back to the tables models.py describes
+UNPARTITION = """
+ALTER TABLE job RENAME TO job_partitioned;
+ALTER TABLE job_partitioned RENAME CONSTRAINT job_pkey TO job_partitioned_pkey;
+ALTER INDEX ix_job_movie_id RENAME TO ix_job_partitioned_movie_id;
+ALTER INDEX ix_job_actor_id RENAME TO ix_job_partitioned_actor_id;
+ALTER TABLE movie RENAME TO movie_partitioned;
+ALTER TABLE movie_partitioned RENAME CONSTRAINT movie_pkey TO movie_partitioned_pkey;
+ALTER INDEX ix_movie_cast_count RENAME TO ix_movie_partitioned_cast_count;
+
+CREATE TABLE movie (
+    id integer NOT NULL DEFAULT nextval('movie_id_seq'),
+    title varchar,
+    release_date timestamp,
+    cast_count integer NOT NULL DEFAULT 0,
+    version integer NOT NULL DEFAULT 1,
+    CONSTRAINT movie_pkey PRIMARY KEY (id)
+);
+CREATE INDEX ix_movie_cast_count ON movie (cast_count);
+INSERT INTO movie SELECT id, title, release_date, cast_count, version FROM movie_partitioned;
+ALTER SEQUENCE movie_id_seq OWNED BY movie.id;
+
+CREATE TABLE job (
+    id integer NOT NULL DEFAULT nextval('job_id_seq'),
+    movie_id integer NOT NULL REFERENCES movie (id) ON DELETE CASCADE,
+    actor_id integer NOT NULL REFERENCES actor (id) ON DELETE CASCADE,
+    version integer NOT NULL DEFAULT 1,
+    CONSTRAINT job_pkey PRIMARY KEY (id)
+);
+INSERT INTO job SELECT id, movie_id, actor_id, version FROM job_partitioned;
+ALTER SEQUENCE job_id_seq OWNED BY job.id;
+
+DROP TABLE job_partitioned;
+DROP TABLE movie_partitioned;
+"""
+
+
+def is_partitioned(connection, table: str):
+    return connection.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+            "WHERE partrelid = to_regclass(:table))"
+        ),
+        {'table': table}
+    ).scalar()
+
+
+def create_movie_partitions(connection, first_year: int, last_year: int):
+    """
+    Creates the yearly movie partitions from first_year to last_year that don't
+    exist yet. A year the default partition already holds movies for can't get
+    its own partition, create them ahead of time
+    """
+    created = []
+    for year in range(first_year, last_year + 1):
+        name = f'movie_y{year}'
+        if connection.execute(text('SELECT to_regclass(:name)'), {'name': name}).scalar() is not None:
+            continue
+        connection.execute(text(
+            f"CREATE TABLE {name} PARTITION OF movie "
+            f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+        ))
+        created.append(name)
+    return created
+
+
+def partition_tables(connection):
+    """
+    Converts movie and job to partitioned tables, keeping their rows
+    """
+    first_year = connection.execute(
+        text('SELECT extract(year FROM min(release_date))::int FROM movie')
+    ).scalar()
+    this_year = datetime.utcnow().year
+
+    connection.execute(text(PARTITION_MOVIE))
+    create_movie_partitions(connection, first_year or this_year, this_year + 1)
+    connection.execute(text(COPY_MOVIE))
+    connection.execute(text(PARTITION_JOB))
+    connection.execute(text(COPY_JOB))
+
+
+def unpartition_tables(connection):
+    connection.execute(text(UNPARTITION))
@@ -0,0 +1,148 @@
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import request
+
+from auth import decode_token, get_token_auth_header, permissions
+
+
+class Profiler:
+    """
+    Sampling profiler for the requests of this worker
+
+    While a profiled request runs, a background thread wakes up every interval
+    seconds and records the stack of the thread handling it (sys._current_frames)
+    under the request's route. Nothing is traced between samples, so a
+    profiled request runs at full speed and the thread sleeps while no request
+    is profiled. Stacks are kept as collapsed stacks, the input of flamegraph.pl
+    and speedscope: frames root first, separated by ;, with a sample count
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.stacks = {}
+        self.requests = Counter()
+        self.samples = 0
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+
+    def start(self, route: str):
+        """Profiles the calling thread under route until stop"""
+        with self._lock:
+            self._threads[threading.get_ident()] = route
+            self.requests[route] += 1
+            # threads don't survive a fork, a worker starts its own
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='profiler', daemon=True).start()
+        self._wakeup.set()
+
+    def stop(self):
+        with self._lock:
+            self._threads.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._threads:
+                    self._wakeup.clear()
+            self.sample()
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, route in self._threads.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                self.stacks.setdefault(route, Counter())[collapse(frame)] += 1
+                self.samples += 1
+
+    def collapsed(self, route: str = None):
+        """
+        One line per stack and route, the route is the root frame
+        """
+        with self._lock:
+            lines = [
+                f'{stack_route};{stack} {count}'
+                for stack_route, stacks in sorted(self.stacks.items())
+                if route is None or stack_route == route
+                for stack, count in stacks.most_common()
+            ]
+        return ''.join(line + '\n' for line in lines)
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+            self.requests.clear()
+            self.samples = 0
+
+    def stats(self):
+        return {
+            'interval_ms': self.interval * 1000,
+            'active': len(self._threads),
+            'samples': self.samples,
+            'requests': dict(self.requests),
+        }
+
+
+def collapse(frame):
+    """
+    The stack ending at frame as module:function frames, root first
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get('__name__', code.co_filename)
+        frames.append(f'{module}:{getattr(code, "co_qualname", code.co_name)}')
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+
+profiler = Profiler()
+
+
+def setup_profiler(app):
+    """
+    setup_profiler(app)
+        a request is profiled when
+            it has an X-Profile: 1 header and a token with the get:runtime
+            permission (the route still checks the token for its own permission)
+            or it is picked at random, PROFILE_SAMPLE_RATE of the requests
+            (0, the default, picks none, 1 profiles the whole worker)
+        samples are taken every PROFILE_INTERVAL_MS
+        /debug/profile serves what was collected
+    """
+    profiler.interval = app.config['PROFILE_INTERVAL_MS'] / 1000
+    sample_rate = app.config['PROFILE_SAMPLE_RATE']
+    permission_bit = permissions.register('get:runtime')
+
+    def requested():
+        if request.headers.get('X-Profile') != '1':
+            return False
+        # deciding whether to profile never fails the request, the route
+        # reports a bad token itself if it needs one
+        try:
+            entry = decode_token(get_token_auth_header())
+        except Exception:
+            return False
+        return entry['mask'] is not None and bool(entry['mask'] & permission_bit)
+
+    @app.before_request
+    def start_profile():
+        if request.url_rule is None or request.endpoint == 'debug_profile':
+            return
+        if (sample_rate and random.random() < sample_rate) or requested():
+            profiler.start(f'{request.method} {request.url_rule.rule}')
+
+    @app.teardown_request
+    def stop_profile(error):
+        profiler.stop()
@@ -0,0 +1,143 @@
+import logging
+import re
+import traceback
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# transaction control, not queries a route can avoid
+IGNORED = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE SAVEPOINT')
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    A request ran more statements than its route's budget, or the same
+    statement shape more often than allowed (an N+1)
+    """
+
+
+'''
+    @query_budget(max_queries, max_repeats) decorator method
+    @INPUTS
+        max_queries: most statements a request to the route may run
+        max_repeats: most times it may run statements of the same shape,
+                     1 unless the route loops over chunks on purpose
+
+    goes next to @requires_auth, only records the budget on the view
+    nothing is counted unless QUERY_BUDGET_MODE is log or raise
+'''
+
+
+def query_budget(max_queries: int, max_repeats: int = 1):
+    def query_budget_decorator(f):
+        f.query_budget = (max_queries, max_repeats)
+        return f
+
+    return query_budget_decorator
+
+
+def extend_query_budget(queries: int, repeats: int = 0):
+    """
+    Gives the current request queries more statements and repeats more runs
+    of one statement shape than its route's @query_budget, for a path of the
+    route that needs them (a retry of an expired Idempotency-Key, a batch
+    read over several chunks). Call it before the statements run
+    """
+    query_log = g.get('query_log') if has_request_context() else None
+    if query_log is None:
+        return
+    if query_log.max_queries is not None:
+        query_log.max_queries += queries
+    if query_log.max_repeats is not None:
+        query_log.max_repeats += repeats
+
+
+def statement_shape(statement: str):
+    """
+    The statement with literals, parameter names and IN lists collapsed,
+    so the same query run with other values has the same shape
+    """
+    shape = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    shape = re.sub(r'%\(\w+\)s|:\w+', '?', shape)
+    shape = re.sub(r'\b\d+\b', '?', shape)
+    shape = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', shape)
+    return re.sub(r'\s+', ' ', shape).strip()
+
+
+class QueryLog:
+    """
+    Statements run while handling one request
+    The stack of the first statement over budget is kept for the report
+    """
+
+    def __init__(self, max_queries: int = None, max_repeats: int = None):
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+        self.count = 0
+        self.shapes = Counter()
+        self.violation = None
+        self.stack = ''
+
+    def record(self, statement: str):
+        shape = statement_shape(statement)
+        if shape.upper().startswith(IGNORED):
+            return
+        self.count += 1
+        self.shapes[shape] += 1
+
+        if self.violation is not None:
+            return
+        if self.max_queries is not None and self.count > self.max_queries:
+            self.violation = f'{self.count} statements, budget is {self.max_queries}'
+        elif self.max_repeats is not None and self.shapes[shape] > self.max_repeats:
+            self.violation = f'{self.shapes[shape]} statements shaped {shape!r}, at most {self.max_repeats} allowed'
+        if self.violation is not None:
+            # drop the frames of this module and of SQLAlchemy's event dispatch
+            self.stack = ''.join(
+                frame for frame in traceback.format_stack()
+                if '/sqlalchemy/' not in frame and __file__ not in frame
+            )
+
+    def report(self, endpoint: str):
+        return f'{endpoint}: {self.violation}\n{self.stack}'
+
+
+def setup_query_budget(app, engine):
+    """
+    setup_query_budget(app, engine)
+        QUERY_BUDGET_MODE
+            off:   nothing is counted (the default)
+            log:   a request over budget is logged with the stack of the
+                   statement that went over
+            raise: it raises QueryBudgetExceeded, which fails the test
+        routes without @query_budget are only checked for N+1s, against
+        QUERY_REPEAT_LIMIT
+    """
+    mode = app.config.get('QUERY_BUDGET_MODE', 'off')
+    if mode == 'off':
+        return
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def record_statement(connection, cursor, statement, parameters, context, executemany):
+        if has_request_context() and 'query_log' in g:
+            g.query_log.record(statement)
+
+    @app.before_request
+    def start_query_log():
+        view = app.view_functions.get(request.endpoint)
+        max_queries, max_repeats = getattr(view, 'query_budget', (None, app.config['QUERY_REPEAT_LIMIT']))
+        g.query_log = QueryLog(max_queries, max_repeats)
+
+    @app.after_request
+    def check_query_log(response):
+        query_log = g.pop('query_log', None)
+        if query_log is None or query_log.violation is None:
+            return response
+        report = query_log.report(request.endpoint)
+        if mode == 'raise':
+            raise QueryBudgetExceeded(report)
+        logger.warning('query budget exceeded by %s', report)
+        return response
@@ -0,0 +1,118 @@
+import os
+import resource
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from sqlalchemy import text
+
+STARTED_AT = time.time()
+
+
+class RequestCounter:
+    """
+    Number of requests this worker is handling right now
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def increment(self):
+        with self._lock:
+            self.value += 1
+
+    def decrement(self):
+        with self._lock:
+            self.value -= 1
+
+
+in_flight = RequestCounter()
+
+
+def memory_usage():
+    """
+    Resident set size of this worker in bytes
+    Read from /proc where available, the peak RSS reported by getrusage otherwise
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def pool_status(engine):
+    """
+    Connection pool counters, pools that don't keep them (e.g. the StaticPool
+    used for in-memory SQLite) only report their class
+    """
+    pool = engine.pool
+    status = {'class': type(pool).__name__}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        counter = getattr(pool, name, None)
+        if counter is not None:
+            status[name] = counter()
+    return status
+
+
+class DatabasePing:
+    """
+    SELECT 1 in a background thread, waited for at most a timeout
+
+    Connecting, waiting for a pooled connection and the query all count
+    against the timeout, an unreachable or wedged database fails the check
+    instead of holding the request. One ping runs at a time: while an earlier
+    one is still stuck, the check fails at once rather than starting another
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._running = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def __call__(self, engine, timeout_ms: int):
+        with self._lock:
+            # threads don't survive a fork, a worker starts its own
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ping')
+                self._running = None
+            if self._running is not None and not self._running.done():
+                raise TimeoutError('an earlier ping is still waiting for the database')
+            self._running = self._executor.submit(select_one, engine, timeout_ms)
+            running = self._running
+        try:
+            running.result(timeout=timeout_ms / 1000)
+        except FutureTimeoutError:
+            raise TimeoutError(f'no answer from the database within {timeout_ms} ms')
+
+
+def select_one(engine, timeout_ms: int):
+    """SELECT 1, on Postgres bounded by a statement timeout as well"""
+    with engine.connect() as connection:
+        if engine.dialect.name != 'postgresql':
+            connection.execute(text('SELECT 1'))
+            return
+
+        # SET LOCAL only lasts until the end of this transaction
+        with connection.begin():
+            connection.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+            connection.execute(text('SELECT 1'))
+
+
+ping_database = DatabasePing()
+
+
+def snapshot(engine, caches: dict):
+    return {
+        'pid': os.getpid(),
+        'uptime': time.time() - STARTED_AT,
+        'rss': memory_usage(),
+        'in_flight': in_flight.value,
+        'pool': pool_status(engine),
+        'caches': {name: cache.stats() for name, cache in caches.items()},
+    }
@@ -0,0 +1,124 @@
+"""
+Helpers for the test suite
+
+Importing this module points the app at config.TestingConfig and fills in
+placeholder Auth0 settings, so it must be imported before app or auth.
+Tokens are signed with a throwaway RSA key whose public half is served to
+auth.py through the AUTH0_JWKS config value, so no live Auth0 tokens or
+network access are needed.
+"""
+import os
+import time
+
+import rsa
+from dotenv import load_dotenv
+from jose import jwk, jwt
+from sqlalchemy import event
+
+load_dotenv()
+
+os.environ['APP_SETTINGS'] = 'config.TestingConfig'
+os.environ.setdefault('AUTH0_DOMAIN', 'agency.test')
+os.environ.setdefault('AUTH0_AUDIENCE', 'agency-test')
+
+from app import create_app  # noqa: E402
+from auth import ALGORITHMS, API_AUDIENCE, AUTH0_DOMAIN, ROLE_PERMISSIONS  # noqa: E402
+from config import TestingConfig  # noqa: E402
+from models import db  # noqa: E402
+
+
+class LocalSigner:
+    """
+    Mints RS256 tokens shaped like the ones Auth0 issues
+    jwks is the matching key set to serve in place of Auth0's
+    """
+    kid = 'local-test-key'
+
+    def __init__(self):
+        # key generation is pure python, 1024 bits keeps it well under a second
+        public_key, private_key = rsa.newkeys(1024)
+        self.private_key = private_key.save_pkcs1().decode()
+
+        key = jwk.construct(public_key.save_pkcs1().decode(), algorithm=ALGORITHMS[0]).to_dict()
+        key.update(kid=self.kid, use='sig')
+        self.jwks = {'keys': [key]}
+
+    def token(self, permissions: list, subject: str = 'auth0|local-test', expires_in: int = 3600):
+        now = int(time.time())
+        claims = {
+            'iss': f'https://{AUTH0_DOMAIN}/',
+            'sub': subject,
+            'aud': API_AUDIENCE,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': permissions,
+        }
+        return jwt.encode(claims, self.private_key, algorithm=ALGORITHMS[0], headers={'kid': self.kid})
+
+    def role_token(self, role: str):
+        return self.token(ROLE_PERMISSIONS[role], subject=f'auth0|{role}')
+
+
+_app = None
+_signer = None
+
+
+def get_signer():
+    global _signer
+    if _signer is None:
+        _signer = LocalSigner()
+    return _signer
+
+
+def get_app():
+    """
+    The app is built once per process, create_all runs once
+    Every pytest-xdist worker is its own process and with the default
+    in-memory SQLite database gets a database of its own
+    """
+    global _app
+    if _app is None:
+        _app = create_app(config=TestingConfig)
+        _app.config['AUTH0_JWKS'] = get_signer().jwks
+    return _app
+
+
+class IsolatedSession:
+    """
+    Runs everything the app does inside one outer transaction that is rolled
+    back on exit. db.session is rebound to a connection holding that
+    transaction plus a SAVEPOINT; a commit() in the app only releases the
+    savepoint, after which a new one is started
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __enter__(self):
+        # keep an app context pushed for the whole test so the test client
+        # reuses it and Flask-SQLAlchemy does not remove the session per request
+        self.context = self.app.app_context()
+        self.context.push()
+
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+
+        self.original_session = db.session
+        db.session = db.create_scoped_session(options={'bind': self.connection, 'binds': {}})
+        session = db.session()
+        session.begin_nested()
+
+        @event.listens_for(session, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        return db.session
+
+    def __exit__(self, *exc_info):
+        db.session.remove()
+        db.session = self.original_session
+        self.transaction.rollback()
+        self.connection.close()
+        self.context.pop()